@@ -1,15 +1,25 @@
 from __future__ import annotations
 
-import csv
-import json
-from dataclasses import dataclass
+import heapq
+import math
+import re
+from collections import deque
 from datetime import datetime
+from functools import lru_cache
 
 import networkx as nx
 from dbt_artifacts_parser.parser import parse_manifest_v7, parse_run_results_v4
 from networkx import DiGraph
 from tabulate import tabulate
 
+from utils.utils import load_json
+
+# dbt resource types that become nodes of the lineage
+_DBT_RESOURCE_TYPES = frozenset({"model", "seed", "source"})
+
+# '%Y-%m-%dT%H:%M:%S' with zero padded fields
+_TIMESTAMP_FORMAT = re.compile(r"[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}")
+
 
 def prettify_critical_path(path: list(), graph: DiGraph):
     output = list()
@@ -27,7 +37,89 @@ def prettify_critical_path(path: list(), graph: DiGraph):
 
     print(tabulate(output, headers=["entity","start_time","end_time","duration","potential_optimisation","next_longest_path"]))
 
-@dataclass
+
+def _parse_timestamp(timestamp: str) -> datetime:
+    """
+    Parses the timestamps of the input files. Most tasks start right when
+    one of their upstreams ends, so the same timestamps show up over and
+    over again, and we only want to parse each of them once.
+    Timestamps are stripped before the cache lookup, so padded and
+    unpadded copies of the same value share their entry.
+    """
+    return _parse_stripped_timestamp(timestamp.strip())
+
+
+@lru_cache(maxsize=4096)
+def _parse_stripped_timestamp(timestamp: str) -> datetime:
+    """
+    Cached parsing of an already stripped timestamp. Repeated timestamps
+    are usually close to each other in the inputs, so a bounded cache
+    catches them without holding every timestamp of every load for the
+    life of the process.
+    fromisoformat is much faster than strptime, but it accepts more than
+    our format (offsets, dates without time, ...) and rejects fields without
+    zero padding (e.g. 01:00:6), so it's only used when the timestamp is
+    exactly in our format. Anything else goes through strptime as before.
+    """
+    if _TIMESTAMP_FORMAT.fullmatch(timestamp):
+        return datetime.fromisoformat(timestamp)
+    return datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S')
+
+
+def _kahn_sort(adjacency: list[tuple[int, ...]], rev_adjacency: list[tuple[int, ...]]) -> list[int]:
+    """
+    Kahn's algorithm over a graph with nodes identified by their integer id.
+    Returns the topological order of the nodes. Nodes that are part of
+    (or downstream of) a cycle never reach zero in-degree, so if the graph
+    is not a DAG the returned order is shorter than the number of nodes.
+    """
+    in_degree = [len(predecessors) for predecessors in rev_adjacency]
+    queue = deque(node for node, degree in enumerate(in_degree) if degree == 0)
+    order = []
+    while queue:
+        node = queue.popleft()
+        order.append(node)
+        for successor in adjacency[node]:
+            in_degree[successor] -= 1
+            if in_degree[successor] == 0:
+                queue.append(successor)
+    return order
+
+
+def _longest_paths(order: list[int], adjacency: list[tuple[int, ...]], weight: list[float]) -> tuple[list[float], list[int]]:
+    """
+    Longest path DP over a DAG, with nodes identified by their integer id.
+    Nodes are visited in the given order, and each one extends the longest
+    path of its adjacent nodes visited before it. Nodes not in the order
+    are ignored, so it can run over a subgraph, or backwards by passing
+    the reversed order and the successors as adjacency.
+    Returns, per node, the length of the longest path reaching it (node
+    included) and the adjacent node that path comes from, or -1.
+    """
+    dist = [-math.inf] * len(weight)
+    parent = [-1] * len(weight)
+    for node in order:
+        best = -1
+        for neighbour in adjacency[node]:
+            if dist[neighbour] > -math.inf and (best == -1 or dist[neighbour] > dist[best]):
+                best = neighbour
+        parent[node] = best
+        dist[node] = weight[node] + (dist[best] if best != -1 else 0)
+    return dist, parent
+
+
+def _backtrack(parent: list[int], node: int) -> list[int]:
+    """
+    Follows the parents left by _longest_paths from node until the start
+    of its path. Returns the path from node backwards.
+    """
+    path = []
+    while node != -1:
+        path.append(node)
+        node = parent[node]
+    return path
+
+
 class Lineage(object):
     """
     Main class that represents the DAG as a networkx graph.
@@ -35,6 +127,16 @@ class Lineage(object):
     creation time.
     """
 
+    __slots__ = (
+        "nx_graph",
+        "_names",
+        "_id_of",
+        "_weight",
+        "_adj",
+        "_rev_adj",
+        "_topo",
+    )
+
     def __init__(self, nodes: dict, edges: list[tuple[str, str]]):
         """
         Builds a lineage class.
@@ -77,51 +179,104 @@ class Lineage(object):
                 weight=self.nx_graph.nodes[edge[0]]["weight"],
             )
 
-        if not nx.is_directed_acyclic_graph(self.nx_graph):
-            raise Exception(
-                "After its creation, the current dependency graph is not a DAG"
-            )
+        self._index_graph(
+            "After its creation, the current dependency graph is not a DAG"
+        )
+
+    def _index_graph(self, cycle_error: str):
+        """
+        Assigns an integer id to every node of the DAG and keeps, per id,
+        its weight and the ids of its successors and predecessors.
+        Traversals can then read plain lists and tuples instead of going
+        through the networkx dicts.
+        The topological order is cached too, so it's computed only once
+        per version of the graph. If there's no such order, the graph is
+        not a DAG: the instance is marked as invalid and we raise cycle_error.
+        """
+        names = list(self.nx_graph.nodes)
+        id_of = {name: index for index, name in enumerate(names)}
+        # adjacency() yields the plain neighbour dicts, without building
+        # a networkx view per node as graph.succ[name] does
+        successors = dict(self.nx_graph.adjacency())
+        predecessors = dict(self.nx_graph.reverse(copy=False).adjacency())
+        adj = [tuple(map(id_of.__getitem__, successors[name])) for name in names]
+        rev_adj = [tuple(map(id_of.__getitem__, predecessors[name])) for name in names]
+        topo = _kahn_sort(adj, rev_adj)
+        if len(topo) < len(names):
+            # leave the instance unusable rather than half indexed
+            self._topo = None
+            raise Exception(cycle_error)
+
+        self._names = names
+        self._id_of = id_of
+        # nodes only referenced by edges (e.g. dbt tests) have no runtimes
+        self._weight = [float(self.nx_graph.nodes[name].get("weight", 0.0)) for name in names]
+        self._adj = adj
+        self._rev_adj = rev_adj
+        self._topo = topo
+
+    def _ancestors_iter(self, task: str) -> bytearray:
+        """
+        Iterative depth first search over the predecessors.
+        Returns a bitmap indexed by node id, marking the task and all its
+        upstreams, so membership checks don't need to hash node names.
+        """
+        if task not in self._id_of:
+            raise Exception(f"The node {task} is not in the graph")
+        seen = bytearray(len(self._names))
+        stack = [self._id_of[task]]
+        seen[stack[0]] = 1
+        while stack:
+            node = stack.pop()
+            for predecessor in self._rev_adj[node]:
+                if not seen[predecessor]:
+                    seen[predecessor] = 1
+                    stack.append(predecessor)
+        return seen
 
     def update_graph(self, corrections: dict):
         """
         Re-builds the networkx DAG based on the
         changes made in corrections.json
         """
-        if "nodes_delete" in corrections:
-            for node_to_remove in corrections["nodes_delete"]:
-                self.nx_graph.remove_node(
-                    node_to_remove["task_id"],
-                )
-        if "nodes_upster" in corrections:
-            for node_to_add in corrections["nodes_upster"]:
-                start_datetime = datetime.strptime(node_to_add.get("task_start_ts").strip(), '%Y-%m-%dT%H:%M:%S')
-                end_datetime = datetime.strptime(node_to_add["task_end_ts"].strip(), '%Y-%m-%dT%H:%M:%S')
-                weight = (end_datetime - start_datetime).total_seconds()
-                self.nx_graph.add_node(
-                    node_to_add["task_id"],
-                    start_time=start_datetime,
-                    end_time=end_datetime,
-                    weight=weight,
-                )
-
-        if "edges_delete" in corrections:
-            for edge_to_delete in corrections["edges_delete"]:
-                if edge_to_delete["source"] and edge_to_delete["target"]:
-                    self.nx_graph.remove_edge(
-                        edge_to_delete["source"], edge_to_delete["target"]
+        # the corrections are applied in place, so the graph is re-indexed
+        # even if one of them fails halfway through
+        try:
+            if "nodes_delete" in corrections:
+                for node_to_remove in corrections["nodes_delete"]:
+                    self.nx_graph.remove_node(
+                        node_to_remove["task_id"],
+                    )
+            if "nodes_upster" in corrections:
+                for node_to_add in corrections["nodes_upster"]:
+                    start_datetime = _parse_timestamp(node_to_add.get("task_start_ts"))
+                    end_datetime = _parse_timestamp(node_to_add["task_end_ts"])
+                    weight = (end_datetime - start_datetime).total_seconds()
+                    self.nx_graph.add_node(
+                        node_to_add["task_id"],
+                        start_time=start_datetime,
+                        end_time=end_datetime,
+                        weight=weight,
                     )
 
-        if "edges_add" in corrections:
-            for edge_to_add in corrections["edges_add"]:
-                if edge_to_add["source"] and edge_to_add["target"]:
-                    self.nx_graph.add_edge(edge_to_add["source"], edge_to_add["target"])
-
-        for edge in self.nx_graph.edges:
-            self.nx_graph[edge[0]][edge[1]]["weight"] = float(
-                self.nx_graph.nodes[edge[0]]["weight"]
-            )
-        if not nx.is_directed_acyclic_graph(self.nx_graph):
-            raise Exception(
+            if "edges_delete" in corrections:
+                for edge_to_delete in corrections["edges_delete"]:
+                    if edge_to_delete["source"] and edge_to_delete["target"]:
+                        self.nx_graph.remove_edge(
+                            edge_to_delete["source"], edge_to_delete["target"]
+                        )
+
+            if "edges_add" in corrections:
+                for edge_to_add in corrections["edges_add"]:
+                    if edge_to_add["source"] and edge_to_add["target"]:
+                        self.nx_graph.add_edge(edge_to_add["source"], edge_to_add["target"])
+
+            for edge in self.nx_graph.edges:
+                self.nx_graph[edge[0]][edge[1]]["weight"] = float(
+                    self.nx_graph.nodes[edge[0]]["weight"]
+                )
+        finally:
+            self._index_graph(
                 "After the corrections, the current dependency graph is not a DAG"
             )
 
@@ -131,56 +286,103 @@ class Lineage(object):
         To reduce the complexity of the problem of finding the longest path to a node,
         we reduce the graph to only have the desired node to explore, and all its upstreams.
         """
-        subgraph_nodes = nx.ancestors(self.nx_graph, task)
-        subgraph_nodes.add(task)
-        subgraph = self.nx_graph.subgraph(subgraph_nodes)
-        return nx.dag_longest_path(subgraph, weight="weight"), subgraph
+        topo_order, _, parent = self._longest_paths_to(task)
+        subgraph = self.nx_graph.subgraph(self._names[node] for node in topo_order)
+        path = _backtrack(parent, self._id_of[task])
+        return [self._names[node] for node in reversed(path)], subgraph
 
-    def find_potential_optimisations(self, task: str) -> tuple[list[str], DiGraph]:
-        """ This is a very hacky method that tries to find the what's
-        the next critical path if there were any optimisations in the graph
+    def _longest_paths_to(self, task: str) -> tuple[list[int], list[float], list[int]]:
         """
-        longest_path_nodes, subgraph = self.find_critical_path(task)
-
-        total = 0
-        for node in longest_path_nodes:
-            duration = subgraph.nodes[node]["weight"]
-            total = total + duration
-
-        for current_task in longest_path_nodes:
-            subtotal = 0
-            optimised_subgraph = subgraph.copy()
-            optimised_subgraph.nodes[current_task]["weight"] = 0
-            downstream_dependencies_one = optimised_subgraph.successors(current_task)
+        Runs the longest path DP over the task and its upstreams.
+        Returns their ids in topological order, and the length and parent
+        of the longest path ending at each of them, so callers can both
+        backtrack the critical path and reuse the DP.
+        """
+        if self._topo is None:
+            raise Exception("The current dependency graph is not a DAG")
+        upstream = self._ancestors_iter(task)
+        topo_order = [node for node in self._topo if upstream[node]]
+        dist, parent = _longest_paths(topo_order, self._rev_adj, self._weight)
+        return topo_order, dist, parent
 
-            for downstream_dependency in downstream_dependencies_one:
-                optimised_subgraph[current_task][downstream_dependency]["weight"] = 0
+    def find_potential_optimisations(self, task: str) -> tuple[list[str], DiGraph]:
+        """
+        For every task in the critical path, finds what the next critical path
+        would be if that task took no time at all.
+        Instead of re-running the longest path per task, we compute once, in
+        topological order, the longest path ending at each node (dist_from_source)
+        and the longest path from each node to the task (dist_to_sink).
+        With those, zeroing a task T leaves us with the best of:
+        * the longest path still going through T, now without T's weight.
+        * the longest path jumping over T: an edge (u, v) with u before T
+          and v after T in the topological order.
+        * the longest path starting after T in the topological order.
+        """
+        # forward pass: longest path ending at each node, node included.
+        # The critical path comes from backtracking its parents.
+        topo_order, dist_from_source, best_predecessor = self._longest_paths_to(task)
+        critical_path = _backtrack(best_predecessor, self._id_of[task])[::-1]
+        longest_path_nodes = [self._names[node] for node in critical_path]
+        subgraph = self.nx_graph.subgraph(self._names[node] for node in topo_order)
+        position = {node: index for index, node in enumerate(topo_order)}
+
+        # reverse pass: longest path from each node to the task, node included.
+        dist_to_sink, best_successor = _longest_paths(topo_order[::-1], self._adj, self._weight)
+
+        # best node to start a path from, among the nodes from each position onwards
+        best_start_from = [-1] * (len(topo_order) + 1)
+        for index in range(len(topo_order) - 1, -1, -1):
+            node, best = topo_order[index], best_start_from[index + 1]
+            best_start_from[index] = node if best == -1 or dist_to_sink[node] > dist_to_sink[best] else best
+
+        def path_to(node):
+            return [self._names[node] for node in reversed(_backtrack(best_predecessor, node))]
+
+        def path_from(node):
+            return [self._names[node] for node in _backtrack(best_successor, node)]
+
+        total = dist_from_source[self._id_of[task]]
+
+        # The critical path is sorted topologically, so we sweep it keeping a heap
+        # of the edges that started before the current task. Edges that end before
+        # the current task will never jump over any of the following ones either.
+        # Edges are generated in topological order of their source.
+        edges = [(source, target) for source in topo_order for target in self._adj[source] if target in position]
+        next_edge = 0
+        jumping_edges = []
+        # serial on purpose: this is pure Python, threads would contend on the GIL
+        for current_id in critical_path:
+            current_task = self._names[current_id]
+            current_position = position[current_id]
+            while next_edge < len(edges) and position[edges[next_edge][0]] < current_position:
+                source, target = edges[next_edge]
+                heapq.heappush(
+                    jumping_edges,
+                    (-(dist_from_source[source] + dist_to_sink[target]), position[target], source, target),
+                )
+                next_edge += 1
+            while jumping_edges and jumping_edges[0][1] <= current_position:
+                heapq.heappop(jumping_edges)
 
-            longest_subpath_optimised_nodes = nx.dag_longest_path(
-                optimised_subgraph, weight="weight"
-            )
+            subtotal = dist_from_source[current_id] + dist_to_sink[current_id] - 2 * self._weight[current_id]
+            next_longest_path = path_to(current_id) + path_from(current_id)[1:]
 
-            for optimised_node in longest_subpath_optimised_nodes:
-                duration = optimised_subgraph.nodes[optimised_node]["weight"]
-                subtotal = subtotal + duration
+            if jumping_edges and -jumping_edges[0][0] > subtotal:
+                _, _, source, target = jumping_edges[0]
+                subtotal = dist_from_source[source] + dist_to_sink[target]
+                next_longest_path = path_to(source) + path_from(target)
 
-            # In some cases we might change to 0 the weight of an edge to the last node (task)
-            # that we are trying to optimise, this means that the longest_path is now only considering
-            # the previous task instead of the last task of the graph.
-            # For that reason, we have to correct this by adding the time of the last task to the subtotal.
-            # not ideal but. FIXME
-            if task not in longest_subpath_optimised_nodes:
-                subtotal = subtotal + optimised_subgraph.nodes[task]["weight"]
+            start = best_start_from[current_position + 1]
+            if start != -1 and dist_to_sink[start] > subtotal:
+                subtotal = dist_to_sink[start]
+                next_longest_path = path_from(start)
 
             subgraph.nodes[current_task]["potential_optimisation"] = total - subtotal
-            subgraph.nodes[current_task][
-                "next_longest_path"
-            ] = longest_subpath_optimised_nodes
+            subgraph.nodes[current_task]["next_longest_path"] = next_longest_path
 
         return longest_path_nodes, subgraph
 
 
-@dataclass
 class DbtLineage(Lineage):
     """
     Builds a networkx lineage graph based on the dbt artefacts.
@@ -188,30 +390,41 @@ class DbtLineage(Lineage):
     but this can be modified.
     """
 
+    __slots__ = ()
+
     def __init__(self, manifest_path: str, run_results_path: str):
 
-        with open(manifest_path) as manifest, open(run_results_path) as rul_results:
+        with open(manifest_path, "rb") as manifest, open(run_results_path, "rb") as rul_results:
             # define the right versions of the manifest and run_results here.
-            manifest_obj = parse_manifest_v7(manifest=json.load(manifest))
-            run_results_obj = parse_run_results_v4(run_results=json.load(rul_results))
+            manifest_obj = parse_manifest_v7(manifest=load_json(manifest))
+            run_results_obj = parse_run_results_v4(run_results=load_json(rul_results))
 
             # We need to join both artefacts to extract:
             # 1- list of nodes and their runtimes (manifest + rul_results)
             # 2- list of edges (manifest)
 
-            # 1. list of nodes and their runtimes (manifest + rul_results)
             times = {result.unique_id: result for result in run_results_obj.results}
+
             # TODO: Although tests could be a bottleneck too, they are ommited in this step
             # A solution could be to either aggregate the times of tests into a single
             # node, or consider them as separate nodes too. This really depends if the
-            node_list = [
-                v.unique_id
-                for k, v in manifest_obj.nodes.items()
-                if v.resource_type.name in ("model", "seed", "source")
-            ]
+
+            # Both lists are collected in a single pass over the manifest:
+            # every node adds its edges (2), and models, seeds and sources
+            # are added to the list of nodes with their runtimes (1).
             nodes = {}
-            for node in node_list:
-                node_times = times[node]
+            edges = []
+            for target, v in manifest_obj.nodes.items():
+                edges.extend((source, target) for source in v.depends_on.nodes)
+                if v.resource_type.name not in _DBT_RESOURCE_TYPES:
+                    continue
+
+                node = v.unique_id
+                node_times = times.get(node)
+                if node_times is None:
+                    raise Exception(
+                        f"The run results of {node} are missing and the weight couldn't be calculated"
+                    )
 
                 started_at = None
                 completed_at = None
@@ -230,17 +443,10 @@ class DbtLineage(Lineage):
                     "end_time": completed_at,
                     "weight": weight,
                 }
-            # 2. list of nodes and their runtimes (manifest + rul_results)
-            edges = [
-                (source, target)
-                for target, v in manifest_obj.nodes.items()
-                for source in v.depends_on.nodes
-            ]
 
         super(DbtLineage, self).__init__(nodes, edges)
 
 
-@dataclass
 class CsvLineage(Lineage):
     """
     Builds a networkx lineage graph based on the dbt artefacts.
@@ -248,24 +454,27 @@ class CsvLineage(Lineage):
     but this can be modified.
     """
 
+    __slots__ = ()
+
     def __init__(self, manifest_path: str, run_results_path: str):
+        # Both files have a fixed schema without any quoted fields, so we
+        # split the lines ourselves instead of going through csv.reader.
         with open(manifest_path) as manifest, open(run_results_path) as run_results:
-            manifest_obj = csv.reader(manifest, delimiter=',', quotechar='|')
-
-            runtimes_obj = csv.reader(run_results, delimiter=',', quotechar='|')
-
-            next(manifest_obj)  # skip header
-            edges = [
-                (row[0].strip(), row[1].strip())
-                for row in manifest_obj
-
-            ]
-
-            nodes = {}
-            next(runtimes_obj)  # skip header
-            for row in runtimes_obj:
-                start_datetime = datetime.strptime(row[1].strip(), '%Y-%m-%dT%H:%M:%S')
-                end_datetime = datetime.strptime(row[2].strip(), '%Y-%m-%dT%H:%M:%S')
+            manifest_lines = manifest.read().splitlines()
+            runtimes_lines = run_results.read().splitlines()
+
+        edges = []
+        for line in manifest_lines[1:]:  # skip header
+            if line.strip():
+                row = line.split(",")
+                edges.append((row[0].strip(), row[1].strip()))
+
+        nodes = {}
+        for line in runtimes_lines[1:]:  # skip header
+            if line.strip():
+                row = line.split(",")
+                start_datetime = _parse_timestamp(row[1])
+                end_datetime = _parse_timestamp(row[2])
                 nodes[row[0].strip()] = {
                     "start_time": start_datetime,
                     "end_time": end_datetime,
@@ -1,9 +1,9 @@
 import argparse
-import json
 import sys
 
 from lineage import DbtLineage, CsvLineage, prettify_critical_path
 from print_dag import export
+from utils.utils import load_json
 
 
 def main(input_args):
@@ -12,8 +12,8 @@ def main(input_args):
         "resources/csv/runtimes.csv"
     )
 
-    with open("resources/json/corrections.json") as corrections:
-        graph.update_graph(json.load(corrections))
+    with open("resources/json/corrections.json", "rb") as corrections:
+        graph.update_graph(load_json(corrections))
 
     path, subgraph = graph.find_critical_path(input_args.model)
     export(subgraph, path, "pdf")
@@ -1,4 +1,5 @@
-from datetime import timedelta
+import re
+from datetime import datetime, timedelta
 
 from graphviz import Digraph
 from networkx import DiGraph
@@ -7,6 +8,7 @@ from utils.utils import suppress_stdout_stderr
 
 INTERVAL_IN_SECONDS = 1  # selected interval in the timeline
 AVOID_OVERLAP = True  # True to improve visualisation
+SAFE_DOT_ID = re.compile(r"[a-zA-Z0-9_.]+")  # ids we can quote without escaping
 
 
 def export(
@@ -53,6 +55,22 @@ def find_interval(timestamp, start_timeline) -> int:
     return int(timestamp - start_timeline.timestamp()) // INTERVAL_IN_SECONDS
 
 
+def timeline_labels(start: datetime, ranks: list[int]) -> list[str]:
+    """
+    Labels (as in %I:%M:%S) of the given intervals of the timeline, starting at start.
+    Long runs have thousands of intervals, so instead of creating and
+    formatting a datetime per interval, we work out the clock time of each
+    one from the seconds of the day of the start.
+    """
+    start_seconds = start.hour * 3600 + start.minute * 60 + start.second
+    labels = []
+    for rank in ranks:
+        hours, seconds = divmod((start_seconds + rank * INTERVAL_IN_SECONDS) % 86400, 3600)
+        minutes, seconds = divmod(seconds, 60)
+        labels.append(f"{hours % 12 or 12:02d}:{minutes:02d}:{seconds:02d}")
+    return labels
+
+
 def generate_graph(nx_graph: DiGraph, longest_path_nodes: list) -> Digraph:
     """
     Following the logic in
@@ -94,28 +112,10 @@ def generate_graph(nx_graph: DiGraph, longest_path_nodes: list) -> Digraph:
 
     graph = build_graph_properties("graph")
 
-    # Create the data grid, based on the earliet and latests tasks in the DAG
-    start_timeline = min(
-        [value["start_time"] for key, value in nx_graph.nodes().items()]
-    )
-    end_timeline = max([value["end_time"] for key, value in nx_graph.nodes().items()])
-
-    # Build the different interval blocks based on INTERVAL_IN_SECONDS
-    # This will create a timeline in our graph as follows:
-    # start_timeline --> T --> T+1 --> T+2 --> ... -> end_timeline
-    # We will use each interval to rank the models by start/end
-    interval = start_timeline
-    rank = 0
-
-    while interval < end_timeline:
-        graph.node(str(rank), label=(interval + timedelta(seconds=1)).strftime("%I:%M:%S"), fontsize="50pt")
-        interval += timedelta(seconds=INTERVAL_IN_SECONDS)
-        # this  will avoid creating an empty node
-        # at the end of the timeline
-        if interval < end_timeline:
-            graph.edge(str(rank), str(rank + 1))
-            rank = rank + 1
+    # Create the data grid, based on the earliet task in the DAG
+    start_timeline = min(metadata["start_time"] for metadata in nx_graph.nodes().values())
 
+    alignments = {}
     for node, metadata in nx_graph.nodes().items():
         # find the alignments with respect to the start_time
         start_align = find_interval(metadata["start_time"].timestamp(), start_timeline)
@@ -130,7 +130,29 @@ def generate_graph(nx_graph: DiGraph, longest_path_nodes: list) -> Digraph:
             # avoid the end being longer than the start
             if end_align < start_align:
                 end_align = start_align
+        alignments[node] = (start_align, end_align)
 
+    # Build the different interval blocks based on INTERVAL_IN_SECONDS
+    # This will create a timeline in our graph as follows:
+    # start_timeline --> T --> T+3 --> T+4 --> ... -> end_timeline
+    # We will use each interval to rank the models by start/end, so we
+    # only need the intervals where a model starts or ends, and skip
+    # the rest of them to keep the graph (and its layout) small.
+    ranks = sorted({align for node_alignments in alignments.values() for align in node_alignments})
+    # Ranks and labels are always safe DOT, so we write the timeline
+    # straight into the body instead of going through graph.node/graph.edge
+    timeline = []
+    labels = timeline_labels(start_timeline + timedelta(seconds=1), ranks)
+    for index, (rank, label) in enumerate(zip(ranks, labels)):
+        timeline.append(f'\t{rank} [label="{label}" fontsize="50pt"]\n')
+        if index + 1 < len(ranks):
+            timeline.append(f"\t{rank} -> {ranks[index + 1]}\n")
+    graph.body.extend(timeline)
+
+    # upstreams of every node, looked up once instead of per cluster
+    predecessors = {node: list(nx_graph.pred[node]) for node in nx_graph.nodes}
+
+    for node, (start_align, end_align) in alignments.items():
         # clusters in graphviz are an extension of subgraphs
         # where the name of the node must start with cluster_
         with graph.subgraph(name="cluster_" + node) as c:
@@ -165,13 +187,21 @@ def generate_graph(nx_graph: DiGraph, longest_path_nodes: list) -> Digraph:
                 s.node(str(start_align))
                 s.node(node_start)
 
-            # create all the edges
-            for upstream in nx_graph.predecessors(node):
-                graph.edge(
-                    upstream,
-                    node_start,
-                    ltail="cluster_" + upstream,
-                    lhead="cluster_" + node,
-                )
+            # create all the edges. Names that don't need escaping
+            # are written straight into the body in one go.
+            edges = []
+            for upstream in predecessors[node]:
+                if SAFE_DOT_ID.fullmatch(upstream) and SAFE_DOT_ID.fullmatch(node):
+                    edges.append(
+                        f'\t"{upstream}" -> "{node_start}" [lhead="cluster_{node}" ltail="cluster_{upstream}"]\n'
+                    )
+                else:
+                    graph.edge(
+                        upstream,
+                        node_start,
+                        ltail="cluster_" + upstream,
+                        lhead="cluster_" + node,
+                    )
+            graph.body.extend(edges)
 
     return graph
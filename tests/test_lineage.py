@@ -0,0 +1,144 @@
+import random
+import unittest
+from datetime import datetime, timedelta
+
+import networkx as nx
+
+from lineage import CsvLineage, Lineage, _parse_timestamp
+
+
+def random_lineage(seed: int, size: int = 25, density: float = 0.15) -> Lineage:
+    """
+    Random DAG with small integer runtimes, so there are plenty of ties
+    and zero weight tasks.
+    """
+    rng = random.Random(seed)
+    start = datetime(2023, 6, 1)
+    nodes = {}
+    for index in range(size):
+        weight = rng.choice([0, 1, 2, 3, 5, 8, rng.randint(0, 30)])
+        nodes[f"task_{index}"] = {
+            "start_time": start,
+            "end_time": start + timedelta(seconds=weight),
+            "weight": float(weight),
+        }
+    edges = [
+        (f"task_{source}", f"task_{target}")
+        for source in range(size)
+        for target in range(source + 1, size)
+        if rng.random() < density
+    ]
+    rng.shuffle(edges)
+    return Lineage(nodes, edges)
+
+
+def chain_lineage() -> Lineage:
+    """
+    a -> b -> c -> d, each task taking one second.
+    """
+    start = datetime(2023, 6, 1)
+    nodes = {
+        name: {"start_time": start, "end_time": start + timedelta(seconds=1), "weight": 1.0}
+        for name in "abcd"
+    }
+    return Lineage(nodes, [("a", "b"), ("b", "c"), ("c", "d")])
+
+
+def longest_path_length(graph: nx.DiGraph, task: str, zeroed: str = None) -> float:
+    """
+    Brute force: length of the longest path to the task,
+    with the weight of zeroed set to 0.
+    """
+    upstream = nx.ancestors(graph, task) | {task}
+    length = {}
+    for node in nx.topological_sort(graph.subgraph(upstream)):
+        weight = 0 if node == zeroed else graph.nodes[node]["weight"]
+        length[node] = weight + max((length[p] for p in graph.predecessors(node)), default=0)
+    return length[task]
+
+
+class TestFindPotentialOptimisations(unittest.TestCase):
+    def test_csv_example(self):
+        graph = CsvLineage("resources/csv/edges.csv", "resources/csv/runtimes.csv")
+        path, subgraph = graph.find_potential_optimisations("i")
+
+        self.assertEqual(path, ["c", "b", "h", "i"])
+        self.assertEqual(
+            [subgraph.nodes[node]["potential_optimisation"] for node in path],
+            [2, 3, 4, 5],
+        )
+        self.assertEqual(subgraph.nodes["c"]["next_longest_path"], ["a", "b", "h", "i"])
+
+    def test_matches_brute_force(self):
+        for seed in range(200):
+            graph = random_lineage(seed)
+            for task in list(graph.nx_graph)[-5:]:
+                with self.subTest(seed=seed, task=task):
+                    path, subgraph = graph.find_potential_optimisations(task)
+                    total = longest_path_length(graph.nx_graph, task)
+
+                    self.assertEqual(path[-1], task)
+                    self.assertAlmostEqual(
+                        sum(graph.nx_graph.nodes[node]["weight"] for node in path), total
+                    )
+                    for node in path:
+                        optimised = longest_path_length(graph.nx_graph, task, zeroed=node)
+                        self.assertAlmostEqual(
+                            subgraph.nodes[node]["potential_optimisation"], total - optimised
+                        )
+
+                        next_path = subgraph.nodes[node]["next_longest_path"]
+                        self.assertEqual(next_path[-1], task)
+                        self.assertTrue(nx.is_path(graph.nx_graph, next_path))
+                        self.assertAlmostEqual(
+                            sum(
+                                0 if other == node else graph.nx_graph.nodes[other]["weight"]
+                                for other in next_path
+                            ),
+                            optimised,
+                        )
+
+
+class TestParseTimestamp(unittest.TestCase):
+    def test_unpadded_value(self):
+        self.assertEqual(_parse_timestamp("2023-06-01T01:00:6"), datetime(2023, 6, 1, 1, 0, 6))
+
+    def test_padded_and_unpadded_match(self):
+        self.assertEqual(
+            _parse_timestamp("2023-06-01T01:00:06"), _parse_timestamp("2023-06-01T01:00:6")
+        )
+
+    def test_offset_is_rejected(self):
+        with self.assertRaises(ValueError):
+            _parse_timestamp("2023-06-01T01:00:00+00:00")
+
+
+class TestUpdateGraph(unittest.TestCase):
+    def test_failing_correction_keeps_index_in_sync(self):
+        graph = chain_lineage()
+        with self.assertRaises(nx.NetworkXError):
+            graph.update_graph({"nodes_delete": [{"task_id": "a"}, {"task_id": "zz"}]})
+
+        # a was removed before the failure, so it's gone from the index too
+        path, _ = graph.find_critical_path("d")
+        self.assertEqual(path, ["b", "c", "d"])
+
+    def test_cycle_at_creation(self):
+        start = datetime(2023, 6, 1)
+        nodes = {name: {"start_time": start, "end_time": start, "weight": 0.0} for name in "ab"}
+        with self.assertRaisesRegex(Exception, "After its creation.*not a DAG"):
+            Lineage(nodes, [("a", "b"), ("b", "a")])
+
+    def test_cycle_after_corrections(self):
+        graph = chain_lineage()
+        with self.assertRaisesRegex(Exception, "After the corrections.*not a DAG"):
+            graph.update_graph({"edges_add": [{"source": "c", "target": "b"}]})
+
+        with self.assertRaisesRegex(Exception, "not a DAG"):
+            graph.find_critical_path("d")
+        with self.assertRaisesRegex(Exception, "not a DAG"):
+            graph.find_potential_optimisations("d")
+
+
+if __name__ == "__main__":
+    unittest.main()
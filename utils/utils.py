@@ -1,9 +1,26 @@
+import json
 from contextlib import contextmanager, redirect_stderr, redirect_stdout
 from os import devnull
 
+try:
+    import orjson
+except ImportError:  # orjson is optional, the standard json module works too
+    orjson = None
+
+
 @contextmanager
 def suppress_stdout_stderr():
     """A context manager that redirects stdout and stderr to devnull"""
     with open(devnull, 'w') as fnull:
         with redirect_stderr(fnull) as err, redirect_stdout(fnull) as out:
             yield err, out
+
+
+def load_json(file):
+    """
+    Parses a json file opened in binary mode, with orjson if it's installed.
+    orjson is a few times faster on big files, like dbt manifests.
+    """
+    if orjson is not None:
+        return orjson.loads(file.read())
+    return json.load(file)